@@ -4,4 +4,4 @@ Quelle: https://github.com/FloHofstetter/wcid-keras
 Letzter Zugriff: 01.08.2023
 '''
 from .dataset import *
-from .augment import augment_images
+from .augment import augment_images, list_backgrounds
@@ -3,7 +3,7 @@ Autor: Florian Hofstetter
 Quelle: https://github.com/FloHofstetter/wcid-keras
 Letzter Zugriff: 01.08.2023
 '''
-from typing import Union, List, Tuple
+from typing import Union, List, Sequence, Tuple
 import pathlib
 import random
 
@@ -12,11 +12,28 @@ import numpy as np
 from PIL import Image
 
 
+def list_backgrounds(
+    bg_dir_pth: Union[pathlib.Path, str],
+    bg_ext: str,
+) -> List[pathlib.Path]:
+    """
+    Collect available background images.
+    Listing is meant to be done once and passed to every
+    call of augment_images.
+
+    :param bg_dir_pth: Path to background image directory.
+    :param bg_ext: Background image file extension.
+    :return: Sorted paths of the background images.
+    """
+    # Get path if string provided.
+    bg_dir_pth = pathlib.Path(bg_dir_pth)
+    return sorted(bg_dir_pth.glob(f"*.{bg_ext}"))
+
+
 def augment_images(
     fg_arr: np.ndarray,
     msk_arr: np.ndarray,
-    bg_dir_pth: Union[pathlib.Path, str],
-    bg_ext: str,
+    bg_pths: Sequence[Union[pathlib.Path, str]],
     p: float = 1.0,
 ) -> np.ndarray:
     """
@@ -28,8 +45,7 @@ def augment_images(
 
     :param fg_arr: Foreground image as numpy array.
     :param msk_arr: Mask image as numpy array.
-    :param bg_dir_pth: Path to background image directory.
-    :param bg_ext: Background image file extension.
+    :param bg_pths: Paths to the background images.
     :param p: Probability to apply augmentation.
     :return: Augmented image as numpy array.
     """
@@ -38,14 +54,9 @@ def augment_images(
 
     # Apply augmentation.
     if rand_nr < p:
-        # Get path if string provided.
-        bg_dir_pth = pathlib.Path(bg_dir_pth)
         # Convert RGB input to cv2 native color order
         fg_arr: np.ndarray = cv2.cvtColor(fg_arr, cv2.COLOR_RGB2BGR)
 
-        # Collect available background images.
-        bg_pths: List = list(bg_dir_pth.glob(f"*.{bg_ext}"))
-
         # Choose random background and open
         # and resize to foreground.
         bg_pth: Union[pathlib.Path, str]
@@ -109,7 +120,8 @@ def main() -> None:
     msk_arr: np.ndarray = np.asarray(msk_img)
 
     # Augment images.
-    blended: np.ndarray = augment_images(fg_arr, msk_arr, bg_pth, bg_ext)
+    bg_pths: List[pathlib.Path] = list_backgrounds(bg_pth, bg_ext)
+    blended: np.ndarray = augment_images(fg_arr, msk_arr, bg_pths)
 
     # Show blended image.
     blended_img: Image.Image = Image.fromarray(blended)
@@ -3,18 +3,95 @@ Autor: Florian Hofstetter
 Quelle: https://github.com/FloHofstetter/wcid-keras
 Letzter Zugriff: 01.08.2023
 '''
-import glob
 import os
 import pathlib
-import random
-from typing import Tuple, List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Tuple, List, Dict
 
 from tensorflow import keras
+import tensorflow as tf
+import cv2
 import numpy as np
-from PIL import Image
+from numba import njit
 import albumentations as A
 
-from .augment import augment_images
+from .augment import augment_images, list_backgrounds
+
+
+@njit(cache=True)
+def _check_binary(msk_arr: np.ndarray) -> int:
+    """
+    Search a mask for classes other than 0 and 1 in a single pass.
+
+    :param msk_arr: Mask array of type uint8.
+    :return: First class greater than 1, 0 if the mask is binary.
+    """
+    for cls in msk_arr.flat:
+        if cls > 1:
+            return cls
+    return 0
+
+
+@njit(cache=True)
+def _finalize(
+    img_arr: np.ndarray,
+    msk_arr: np.ndarray,
+    img_batch: np.ndarray,
+    msk_batch: np.ndarray,
+    batch_pos: int,
+) -> None:
+    """
+    Write a uint8 image and mask into float32 batches in a single pass.
+    Image is scaled to [0, 1] on the way.
+
+    :param img_arr: Image array (height, width, channels).
+    :param msk_arr: Mask array (height, width, 1).
+    :param img_batch: Image batch to write into.
+    :param msk_batch: Mask batch to write into.
+    :param batch_pos: Position of the sample in the batch.
+    :return: None.
+    """
+    scale = np.float32(1.0 / 255.0)
+    height, width, channels = img_arr.shape
+    for y in range(height):
+        for x in range(width):
+            for c in range(channels):
+                img_batch[batch_pos, y, x, c] = img_arr[y, x, c] * scale
+            msk_batch[batch_pos, y, x, 0] = msk_arr[y, x, 0]
+
+
+def _apply_random(
+    aug_fn: Callable[[tf.Tensor], tf.Tensor],
+    batch: tf.Tensor,
+    prb: float,
+) -> tf.Tensor:
+    """
+    Apply an augmentation to every sample of a batch with a probability.
+
+    :param aug_fn: Augmentation for a whole batch.
+    :param batch: Batch of shape (batch, height, width, channels).
+    :param prb: Probability to apply the augmentation per sample.
+    :return: Partly augmented batch.
+    """
+    aug_batch = aug_fn(batch)
+    apply = tf.random.uniform((tf.shape(batch)[0], 1, 1, 1)) < prb
+    return tf.where(apply, aug_batch, batch)
+
+
+def _is_sample_file(entry: os.DirEntry, ftype: str) -> bool:
+    """
+    Check a directory entry like glob("*.ftype") would.
+    Directories and hidden files, e.g. AppleDouble "._" files, are skipped.
+
+    :param entry: Directory entry from os.scandir.
+    :param ftype: File extension without dot.
+    :return: True if the entry is a sample file.
+    """
+    return (
+        entry.name.endswith(f".{ftype}")
+        and not entry.name.startswith(".")
+        and entry.is_file()
+    )
 
 
 class RailDataset(keras.utils.Sequence):
@@ -33,6 +110,8 @@ class RailDataset(keras.utils.Sequence):
         transforms: bool = True,
         tfs_prb: Dict = {},
         bg_dir_pth: str = None,
+        cache_pth: str = None,
+        dtype: type = np.float32,
     ) -> None:
         """
         Set up the parameters of the Dataset.
@@ -46,6 +125,11 @@ class RailDataset(keras.utils.Sequence):
         :param transforms: Activate image augmentations.
         :param tfs_prb: Dict of augmentation probabilities.
         :param bg_dir_pth: Directory to images for background augmentation.
+        :param cache_pth: File to cache the decoded samples, None keeps
+            them in memory. All samples are decoded on construction and
+            take width * height * 4 bytes each, about 200 KB at 320x160.
+        :param dtype: Float type of the returned batches. Use np.float16
+            for models with mixed precision to halve the transferred bytes.
         :return: None.
         """
         self.imgs_pth: str = imgs_pth
@@ -57,44 +141,64 @@ class RailDataset(keras.utils.Sequence):
         self.batch_size = batch_size
         self.transforms = transforms
         self.tfs_prb = tfs_prb
+        self.dtype: np.dtype = np.dtype(dtype)
+
+        # Collect background image paths once
+        self._bg_pths: List[pathlib.Path] = []
+        if bg_dir_pth is not None:
+            self._bg_pths = list_backgrounds(bg_dir_pth, "jpg")
 
         # Collect image paths
-        imgs_pth: str = os.path.join(imgs_pth, f"*.{img_ftype}")
-        img_pths: List[str] = glob.glob(imgs_pth)
-        # Sort to get for every image corresponding mask
-        img_pths = sorted(img_pths)
-
-        # Collect mask paths
-        msks_pth: str = os.path.join(msks_pth, f"*.{msk_ftype}")
-        msk_pths: List[str] = glob.glob(msks_pth)
-        # Sort to get for every mask corresponding image
-        msk_pths = sorted(msk_pths)
-
-        # Shuffle lists in the same way
-        shuffled_list: List = list(zip(img_pths, msk_pths))
-        random.shuffle(shuffled_list)
-        self.img_pths, self.msk_pths = zip(*shuffled_list)
+        # Sort to get a reproducible order before shuffling
+        img_pths: List[str] = sorted(
+            entry.path
+            for entry in os.scandir(imgs_pth)
+            if _is_sample_file(entry, img_ftype)
+        )
+
+        # Collect mask paths by name to find for every image corresponding mask
+        msk_pths_by_stem: Dict[str, str] = {
+            os.path.splitext(entry.name)[0]: entry.path
+            for entry in os.scandir(msks_pth)
+            if _is_sample_file(entry, msk_ftype)
+        }
 
         # Sanity checks
         if res[0] < 1 or res[1] < 1:
             err = f"Resolution mus be grater than 1, got {res}"
             raise ValueError(err)
 
-        if not len(self.img_pths) == len(self.msk_pths):
+        if not len(img_pths) == len(msk_pths_by_stem):
             err = (
                 f"Amount of images and masks must be the same,"
-                + f"got {len(self.img_pths)} and"
-                + f" {len(self.msk_pths)} masks"
+                + f"got {len(img_pths)} and"
+                + f" {len(msk_pths_by_stem)} masks"
             )
             raise ValueError(err)
 
-        for img_pth, msk_pth in zip(self.img_pths, self.msk_pths):
-            img_pth, msk_pth = pathlib.Path(img_pth), pathlib.Path(msk_pth)
-            if img_pth.stem != msk_pth.stem:
+        # Pair every image with the mask of the same name
+        msk_pths: List[str] = []
+        for img_pth in img_pths:
+            img_stem = os.path.splitext(os.path.basename(img_pth))[0]
+            if img_stem not in msk_pths_by_stem:
                 msg = "Expected same name of image and mask, got "
-                msg += f"image-name {img_pth.stem} and mask-name "
-                msg += f"{msk_pth.stem}."
+                msg += f"image-name {img_stem} without mask."
                 raise ValueError(msg)
+            msk_pths.append(msk_pths_by_stem[img_stem])
+
+        self.img_pths: np.ndarray = np.array(img_pths, dtype=object)
+        self.msk_pths: np.ndarray = np.array(msk_pths, dtype=object)
+
+        # Decode and resize every image and mask once, all epochs reuse them
+        self._build_cache(cache_pth)
+
+        # Shuffled order in which the cached samples are served
+        self._perm: np.ndarray = np.arange(len(self.img_pths))
+        np.random.shuffle(self._perm)
+
+        # Worker threads to load the samples of a batch in parallel,
+        # created on first use by __getitem__
+        self._pool: ThreadPoolExecutor = None
 
         # Set standard transformation parameters if not present.
         if not "HorizontalFlip" in self.tfs_prb:
@@ -110,6 +214,47 @@ class RailDataset(keras.utils.Sequence):
         if not "BackgroundSwap" in self.tfs_prb:
             self.tfs_prb["BackgroundSwap"] = 0.9
 
+        # Skip augmentation entirely if no transformation can be applied
+        aug_names = (
+            "HorizontalFlip",
+            "RandomBrightnessContrast",
+            "Rotate",
+            "MotionBlur",
+            "BackgroundSwap",
+        )
+        self._aug_enabled: bool = self.transforms and any(
+            self.tfs_prb[aug_name] > 0 for aug_name in aug_names
+        )
+
+        # List transformations once, they are reused for every sample
+        motion_blur = A.MotionBlur(
+            always_apply=False,
+            p=self.tfs_prb["MotionBlur"],
+            blur_limit=(15, 21),
+        )
+        self._transform = A.Compose(
+            [
+                A.HorizontalFlip(
+                    p=self.tfs_prb["HorizontalFlip"],
+                ),
+                A.RandomBrightnessContrast(
+                    p=self.tfs_prb["RandomBrightnessContrast"],
+                ),
+                A.Rotate(
+                    limit=self.tfs_prb["RotateLimit"],
+                    p=self.tfs_prb["Rotate"],
+                ),
+                motion_blur,
+            ]
+        )
+
+        # Transformations without tensorflow counterpart for as_tf_dataset
+        self._cpu_transform = A.Compose([motion_blur])
+
+        # Tensorflow transformations, built by as_tf_dataset if requested
+        self._tf_rotate: keras.layers.Layer = None
+        self._tf_brightness_contrast: keras.Sequential = None
+
     def __len__(self):
         """
         Get length of the amount of batches in the dataset.
@@ -125,99 +270,247 @@ class RailDataset(keras.utils.Sequence):
         :param batch_idx: Index of the iterator.
         :return: Image and mask batch.
         """
-        img_list = []
-        msk_list = []
-        # For every image in the batch
-        for file_idx in range(batch_idx, batch_idx + self.batch_size):
-            # Open images and masks
-            image_img = Image.open(self.img_pths[file_idx])
-            mask_img = Image.open(self.msk_pths[file_idx])
-
-            # Resize images and masks
-            image_img = image_img.resize(self.res)
-            mask_img = mask_img.resize(self.res)
-
-            # Convert images and mask to array
-            image_arr = np.asarray(image_img).copy()
-            mask_arr = np.asarray(mask_img).copy()
-
-            # List transformations
-            transform = A.Compose(
-                [
-                    A.RandomResizedCrop(
-                        height=self.res[1],
-                        width=self.res[0],
-                        p=0.0,
-                        scale=(0.8, 1.0),
-                    ),
-                    A.HorizontalFlip(
-                        p=self.tfs_prb["HorizontalFlip"],
-                    ),
-                    A.RandomBrightnessContrast(
-                        p=self.tfs_prb["RandomBrightnessContrast"],
-                    ),
-                    A.Rotate(
-                        limit=self.tfs_prb["RotateLimit"],
-                        p=self.tfs_prb["Rotate"],
-                    ),
-                    A.MotionBlur(
-                        always_apply=False,
-                        p=self.tfs_prb["MotionBlur"],
-                        blur_limit=(15, 21),
-                    ),
-                ]
-            )
-            # Augment Images
-            if self.transforms:
-                # Blended augmentation
-                if self.bg_dir_pth is None:
-                    msg = "Background image path is None. Expected "
-                    msg += "path to directory with background images."
-                    raise ValueError(msg)
-                image_arr = augment_images(
-                    image_arr,
-                    mask_arr,
-                    bg_dir_pth=pathlib.Path(self.bg_dir_pth),
-                    bg_ext="jpg",
-                    p=self.tfs_prb["BackgroundSwap"],
-                )
-
-                # Albumentations augmentation
-                augmentations = transform(image=image_arr, mask=mask_arr)
-                image_arr = augmentations["image"]
-                mask_arr = augmentations["mask"]
-
-            # Make sure only 2 classes
-            highest_class = np.max(mask_arr)
-            lowest_class = np.min(mask_arr)
-            if highest_class > 1 or lowest_class < 0:
-                classes = np.unique(mask_arr)
-                err = f"Expected two classes [0 1], got {len(classes)}: {classes}."
-                raise ValueError(err)
-
-            # Expand Mask dimension
-            mask_arr = np.expand_dims(mask_arr, axis=0)
-
-            # Cast datatype and normalize Image
-            image_arr = image_arr.astype(np.float32)
-            mask_arr = mask_arr.astype(np.float32)
-
-            # Scale images
-            image_arr /= 255.0
-
-            # Height width channels to channel height width
-            img_trans = image_arr.transpose((0, 1, 2))
-            mask_arr = mask_arr.transpose((1, 2, 0))
-
-            # List of arrays
-            img_list.append(img_trans)
-            msk_list.append(mask_arr)
-
-        img_batch = np.stack(img_list)
-        msk_batch = np.stack(msk_list)
+        if not 0 <= batch_idx < len(self):
+            err = f"Batch index must be in [0, {len(self)}), got {batch_idx}."
+            raise IndexError(err)
+
+        height, width = self.res[1], self.res[0]
+        img_batch = np.empty((self.batch_size, height, width, 3), dtype=self.dtype)
+        msk_batch = np.empty((self.batch_size, height, width, 1), dtype=self.dtype)
+        # Load every image in the batch in parallel
+        batch_start = batch_idx * self.batch_size
+        smpl_idxs = self._perm[batch_start : batch_start + self.batch_size]
+        # Buffers are uninitialized, every row has to be written
+        assert len(smpl_idxs) == self.batch_size
+        smpls = self._get_pool().map(self._load_sample, smpl_idxs)
+        if self.dtype == np.float32:
+            # Cast and normalize in one fused pass
+            for batch_pos, (image_arr, mask_arr) in enumerate(smpls):
+                _finalize(image_arr, mask_arr, img_batch, msk_batch, batch_pos)
+        else:
+            # Numba lacks float16, assignment casts without temporaries
+            for batch_pos, (image_arr, mask_arr) in enumerate(smpls):
+                img_batch[batch_pos] = image_arr
+                msk_batch[batch_pos] = mask_arr
+
+            # Normalize the whole batch at once
+            img_batch *= self.dtype.type(1.0 / 255.0)
 
         return img_batch, msk_batch
 
+    def _get_pool(self) -> ThreadPoolExecutor:
+        """
+        Get the thread pool to load samples of a batch.
+        Pool is created on first use, datasets only consumed through
+        as_tf_dataset never start threads.
+
+        :return: Thread pool.
+        """
+        if self._pool is None:
+            n_workers = min(self.batch_size, os.cpu_count() or 1)
+            self._pool = ThreadPoolExecutor(max_workers=n_workers)
+        return self._pool
+
+    def _build_cache(self, cache_pth: str = None) -> None:
+        """
+        Decode and resize all samples into one packed uint8 array.
+        Mask is stored as fourth channel behind the image channels.
+
+        :param cache_pth: File to memory map the cache, None keeps the
+            cache in memory.
+        :return: None.
+        """
+        shape = (len(self.img_pths), self.res[1], self.res[0], 4)
+        if cache_pth is None:
+            self._cache = np.empty(shape, dtype=np.uint8)
+        else:
+            self._cache = np.memmap(cache_pth, mode="w+", dtype=np.uint8, shape=shape)
+
+        with ThreadPoolExecutor() as pool:
+            # Consume results to raise errors of the workers
+            list(pool.map(self._cache_sample, range(shape[0])))
+
+        if cache_pth is not None:
+            self._cache.flush()
+
+    def _cache_sample(self, smpl_idx: int) -> None:
+        """
+        Decode and resize a single image and mask into the cache.
+
+        :param smpl_idx: Index of the sample in the path lists.
+        :return: None.
+        """
+        # Ignore EXIF orientation, masks carry none and would not match
+        image_arr = cv2.imread(
+            self.img_pths[smpl_idx],
+            cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION,
+        )
+        mask_arr = cv2.imread(self.msk_pths[smpl_idx], cv2.IMREAD_GRAYSCALE)
+        if image_arr is None or mask_arr is None:
+            msg = f"Could not read image {self.img_pths[smpl_idx]} "
+            msg += f"or mask {self.msk_pths[smpl_idx]}."
+            raise ValueError(msg)
+
+        # Area interpolation for downsampling, nearest keeps mask classes
+        image_arr = cv2.resize(image_arr, self.res, interpolation=cv2.INTER_AREA)
+        mask_arr = cv2.resize(mask_arr, self.res, interpolation=cv2.INTER_NEAREST)
+
+        # Convert cv2 native color order to RGB
+        self._cache[smpl_idx, ..., :3] = cv2.cvtColor(image_arr, cv2.COLOR_BGR2RGB)
+        self._cache[smpl_idx, ..., 3] = mask_arr
+
+    def _load_sample(
+        self, smpl_idx: int, tf_augment: bool = False
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Augment a single cached image and mask.
+
+        :param smpl_idx: Index of the sample in the cache.
+        :param tf_augment: Leave transformations available in tensorflow
+            to _tf_augment.
+        :return: Image and mask array of type uint8.
+        """
+        # Views into the cache, augmentations return new arrays and
+        # OpenCV copies strided inputs only if a transformation applies
+        smpl_arr = self._cache[smpl_idx]
+        image_arr = smpl_arr[..., :3]
+        mask_arr = smpl_arr[..., 3]
+
+        # Augment Images
+        if self._aug_enabled:
+            # Blended augmentation
+            if self.bg_dir_pth is None:
+                msg = "Background image path is None. Expected "
+                msg += "path to directory with background images."
+                raise ValueError(msg)
+            image_arr = augment_images(
+                image_arr,
+                mask_arr,
+                bg_pths=self._bg_pths,
+                p=self.tfs_prb["BackgroundSwap"],
+            )
+
+            # Albumentations augmentation
+            transform = self._cpu_transform if tf_augment else self._transform
+            augmentations = transform(image=image_arr, mask=mask_arr)
+            image_arr = augmentations["image"]
+            mask_arr = augmentations["mask"]
+
+        # Make sure only 2 classes
+        if _check_binary(mask_arr):
+            classes = np.unique(mask_arr)
+            err = f"Expected two classes [0 1], got {len(classes)}: {classes}."
+            raise ValueError(err)
+
+        # Mask in the same contiguous height width channels layout as image
+        mask_arr = np.ascontiguousarray(mask_arr.reshape(self.res[1], self.res[0], 1))
+
+        return image_arr, mask_arr
+
+    def _build_tf_augment(self) -> None:
+        """
+        Build the tensorflow layers used by _tf_augment once.
+
+        :return: None.
+        """
+        if self._tf_rotate is not None:
+            return
+        rot_lim = self.tfs_prb["RotateLimit"]
+        if np.isscalar(rot_lim):
+            rot_lim = (-rot_lim, rot_lim)
+        self._tf_rotate = keras.layers.RandomRotation(
+            (rot_lim[0] / 360.0, rot_lim[1] / 360.0),
+            fill_mode="reflect",
+        )
+        self._tf_brightness_contrast = keras.Sequential(
+            [
+                keras.layers.RandomBrightness(0.2, value_range=(0.0, 1.0)),
+                keras.layers.RandomContrast(0.2),
+            ]
+        )
+
+    def _tf_augment(
+        self, images: tf.Tensor, masks: tf.Tensor
+    ) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        Augment a normalized batch with tensorflow operations.
+        Geometric transformations are applied to images and masks alike.
+
+        :param images: Image batch scaled to [0, 1].
+        :param masks: Mask batch.
+        :return: Augmented image and mask batch.
+        """
+        # Stack masks behind image channels to transform both the same way
+        stacked = tf.concat([images, masks], axis=-1)
+        stacked = _apply_random(
+            tf.image.flip_left_right,
+            stacked,
+            self.tfs_prb["HorizontalFlip"],
+        )
+        stacked = _apply_random(
+            lambda batch: self._tf_rotate(batch, training=True),
+            stacked,
+            self.tfs_prb["Rotate"],
+        )
+        # Interpolated mask borders back to classes
+        images, masks = stacked[..., :3], tf.round(stacked[..., 3:])
+
+        images = _apply_random(
+            lambda batch: self._tf_brightness_contrast(batch, training=True),
+            images,
+            self.tfs_prb["RandomBrightnessContrast"],
+        )
+        images = tf.clip_by_value(images, 0.0, 1.0)
+
+        return images, masks
+
+    def as_tf_dataset(self, tf_augment: bool = False) -> tf.data.Dataset:
+        """
+        Get the dataset as tf.data pipeline.
+        Samples are loaded in parallel and batches are prefetched,
+        so loading and augmentation overlap with training.
+
+        :param tf_augment: Flip, rotate and change brightness and contrast
+            of whole batches with tensorflow ops in the pipeline instead of
+            Albumentations. Order and contrast formula differ from the
+            Albumentations recipe, masks are rotated bilinear and rounded.
+        :return: Dataset of image and mask batches.
+        """
+        tf_augment = tf_augment and self._aug_enabled
+        if tf_augment:
+            self._build_tf_augment()
+
+        def load_fn(smpl_idx: np.int64) -> Tuple[np.ndarray, np.ndarray]:
+            return self._load_sample(int(smpl_idx), tf_augment=tf_augment)
+
+        def map_fn(smpl_idx: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+            image, mask = tf.numpy_function(
+                load_fn, [smpl_idx], [tf.uint8, tf.uint8]
+            )
+            # Shapes are unknown after numpy_function
+            image.set_shape((self.res[1], self.res[0], 3))
+            mask.set_shape((self.res[1], self.res[0], 1))
+            return image, mask
+
+        def norm_fn(images: tf.Tensor, masks: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+            # Cast datatype and normalize the whole batch at once
+            images = tf.cast(images, tf.float32) * (1.0 / 255.0)
+            masks = tf.cast(masks, tf.float32)
+            if tf_augment:
+                images, masks = self._tf_augment(images, masks)
+            return tf.cast(images, self.dtype), tf.cast(masks, self.dtype)
+
+        dataset = tf.data.Dataset.from_tensor_slices(np.arange(len(self._perm)))
+        # Shuffle dataset again every epoch
+        dataset = dataset.shuffle(len(self.img_pths), reshuffle_each_iteration=True)
+        dataset = dataset.map(
+            map_fn, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False
+        )
+        # Drop last incomplete batch, same as __len__
+        dataset = dataset.batch(self.batch_size, drop_remainder=True)
+        dataset = dataset.map(norm_fn, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
     def on_epoch_end(self):
         """
         Behaviour on end of epoch.
@@ -225,6 +518,4 @@ class RailDataset(keras.utils.Sequence):
         :return:
         """
         # Shuffle dataset again
-        shuffled_list: List = list(zip(self.img_pths, self.msk_pths))
-        random.shuffle(shuffled_list)
-        self.img_pths, self.msk_pths = zip(*shuffled_list)
+        np.random.shuffle(self._perm)
@@ -0,0 +1,115 @@
+'''
+Regression checks for the RailDataset sample cache.
+'''
+import pathlib
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("albumentations")
+pytest.importorskip("numba")
+pytest.importorskip("tensorflow")
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+from dataset import RailDataset, augment_images  # noqa: E402
+
+
+@pytest.fixture
+def dataset(tmp_path: pathlib.Path) -> RailDataset:
+    """
+    Small dataset with every augmentation always applied.
+    """
+    rng = np.random.default_rng(0)
+    img_dir, msk_dir, bg_dir = (tmp_path / name for name in ("img", "msk", "bg"))
+    for dir_pth in (img_dir, msk_dir, bg_dir):
+        dir_pth.mkdir()
+    for idx in range(2):
+        img_arr = rng.integers(0, 256, (40, 64, 3), dtype=np.uint8)
+        msk_arr = np.zeros((40, 64), dtype=np.uint8)
+        msk_arr[10:30, 20:40] = 1
+        cv2.imwrite(str(img_dir / f"{idx}.png"), img_arr)
+        cv2.imwrite(str(msk_dir / f"{idx}.png"), msk_arr)
+    # Entries glob("*.png") skips, they must not be taken as samples
+    (img_dir / "._0.png").write_bytes(b"AppleDouble")
+    (img_dir / "dir.png").mkdir()
+    bg_arr = rng.integers(0, 256, (40, 64, 3), dtype=np.uint8)
+    cv2.imwrite(str(bg_dir / "bg.jpg"), bg_arr)
+
+    tfs_prb = {
+        "HorizontalFlip": 1.0,
+        "RandomBrightnessContrast": 1.0,
+        "Rotate": 1.0,
+        "MotionBlur": 1.0,
+        "BackgroundSwap": 1.0,
+    }
+    return RailDataset(
+        str(img_dir),
+        str(msk_dir),
+        res=(32, 16),
+        batch_size=2,
+        tfs_prb=tfs_prb,
+        bg_dir_pth=str(bg_dir),
+    )
+
+
+def test_augment_strided_cache_views(dataset: RailDataset) -> None:
+    """
+    Strided views into the packed cache are valid augmentation inputs
+    and are never written to.
+    """
+    cache_before = np.array(dataset._cache)
+    smpl_arr = dataset._cache[0]
+    image_arr, mask_arr = smpl_arr[..., :3], smpl_arr[..., 3]
+    assert not image_arr.flags["C_CONTIGUOUS"]
+    assert not mask_arr.flags["C_CONTIGUOUS"]
+
+    blended = augment_images(image_arr, mask_arr, bg_pths=dataset._bg_pths, p=1.0)
+    assert blended.shape == (16, 32, 3)
+
+    augmentations = dataset._transform(image=image_arr, mask=mask_arr)
+    assert augmentations["image"].shape == (16, 32, 3)
+    assert augmentations["mask"].shape == (16, 32)
+
+    img_batch, msk_batch = dataset[0]
+    assert img_batch.shape == (2, 16, 32, 3)
+    assert msk_batch.shape == (2, 16, 32, 1)
+
+    np.testing.assert_array_equal(np.array(dataset._cache), cache_before)
+
+
+def test_batches_cover_epoch(tmp_path: pathlib.Path) -> None:
+    """
+    Batches of one epoch serve every sample exactly once and indices
+    outside the epoch raise.
+    """
+    img_dir, msk_dir = tmp_path / "img", tmp_path / "msk"
+    img_dir.mkdir()
+    msk_dir.mkdir()
+    # Every image is filled with its own gray value to identify it
+    gray_vals = [10, 50, 90, 130, 170, 210]
+    for idx, gray_val in enumerate(gray_vals):
+        img_arr = np.full((16, 32, 3), gray_val, dtype=np.uint8)
+        cv2.imwrite(str(img_dir / f"{idx}.png"), img_arr)
+        cv2.imwrite(str(msk_dir / f"{idx}.png"), np.zeros((16, 32), np.uint8))
+
+    dataset = RailDataset(
+        str(img_dir),
+        str(msk_dir),
+        res=(32, 16),
+        batch_size=3,
+        transforms=False,
+        tfs_prb={},
+    )
+    assert len(dataset) == 2
+
+    served = []
+    for batch_idx in range(len(dataset)):
+        img_batch, _ = dataset[batch_idx]
+        served.extend(np.rint(img_batch[:, 0, 0, 0] * 255).astype(int).tolist())
+    assert sorted(served) == gray_vals
+
+    for batch_idx in (len(dataset), -1):
+        with pytest.raises(IndexError):
+            dataset[batch_idx]
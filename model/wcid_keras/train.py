@@ -34,6 +34,8 @@ def train(
     epochs=1,
     load_echpoint_pth=None,
     bg_dir_pth = None,
+    cache_pth=None,
+    tf_augment=False,
     loss_fn="bce",
     optimizer="adam",
 ):
@@ -54,6 +56,10 @@ def train(
     :param epochs: Training epochs to iterate over dataset.
     :param load_echpoint_pth: Path to load checkpoint.
     :param bg_dir_pth: Directory to images for background augmentation.
+    :param cache_pth: Directory to memory map the decoded training and
+        validation samples, None keeps them in memory.
+    :param tf_augment: Flip, rotate and change brightness and contrast with
+        tensorflow ops in the input pipeline instead of Albumentations.
     :return: None.
     """
     # Get time for save path
@@ -86,6 +92,14 @@ def train(
         checkpoint_pth, "weights-improvement-{epoch:02d}-{val_accuracy:.2f}.hdf5"
     )
 
+    # Files to memory map the decoded samples
+    trn_cache_pth, val_cache_pth = None, None
+    if cache_pth is not None:
+        cache_pth = pathlib.Path(cache_pth)
+        cache_pth.mkdir(parents=True, exist_ok=True)
+        trn_cache_pth = cache_pth.joinpath("trn_cache.bin")
+        val_cache_pth = cache_pth.joinpath("val_cache.bin")
+
     # Data generator for training
     trn_gen = RailDataset(
         trn_img,
@@ -95,7 +109,8 @@ def train(
         msk_ftype="png",
         batch_size=bs,
         tfs_prb=aug_prm,
-        bg_dir_pth=bg_dir_pth
+        bg_dir_pth=bg_dir_pth,
+        cache_pth=trn_cache_pth,
     )
     # Data generator for validation
     val_gen = RailDataset(
@@ -106,6 +121,7 @@ def train(
         msk_ftype="png",
         batch_size=bs,
         transforms=False,
+        cache_pth=val_cache_pth,
     )
 
     model = get_model(input_shape=train_res)
@@ -175,14 +191,11 @@ def train(
         print(k, model.__dict__[k])
 
     # Train model
-    history = model.fit_generator(
-        trn_gen,
-        validation_data=val_gen,
+    history = model.fit(
+        trn_gen.as_tf_dataset(tf_augment=tf_augment),
+        validation_data=val_gen.as_tf_dataset(),
         epochs=epochs,
         callbacks=callbacks,
-        workers=12,
-        use_multiprocessing=True,
-        max_queue_size=100,
     )
 
     # Save Last model
@@ -344,6 +357,24 @@ def parse_args(parser: argparse.ArgumentParser):
     help="Optimizer to use for training.",
     default="adam",
     )
+    parser.add_argument(
+        "--cache_pth",
+        type=pathlib.Path,
+        help=(
+            "Directory to memory map the decoded training and validation "
+            "samples. By default they are kept in memory."
+        ),
+        default=None,
+        required=False,
+    )
+    parser.add_argument(
+        "--tf_augment",
+        action="store_true",
+        help=(
+            "Flip, rotate and change brightness and contrast with tensorflow "
+            "ops in the input pipeline instead of Albumentations."
+        ),
+    )
     parser.add_argument(
     "--resume_pth", 
     help="Path to the model to resume training from.",
@@ -405,6 +436,8 @@ def main():
         bs=bs,
         bg_dir_pth=bg_pth,
         optimizer=optimizer,        
+        cache_pth=args.cache_pth,
+        tf_augment=args.tf_augment,
 
     )
 